@@ -1,21 +1,33 @@
 """Module providing a generated AI walk summary, image, and route map."""
 
 import argparse
-import base64
+import csv
+import datetime
+import hashlib  # For cache keys
+import io
+import importlib.util  # For checking optional dependencies
+import json
+import math
 import os  # For environment variables
+import pickle  # For caching Gemini responses
+import re
+import tempfile  # For writing cache and output files atomically
 import uuid  # For generating unique filenames
+from concurrent.futures import ThreadPoolExecutor, as_completed  # For overlapping API calls
 from enum import Enum
-from io import BytesIO
 
-import folium  # For map visualization
-import gpxpy
-import gpxpy.gpx
+import numpy as np
 from dotenv import load_dotenv  # For loading environment variables
-from google import genai  # For Google Gemini API
-from google.genai import types
-from PIL import Image
+
+# folium, gpxpy, PIL and google.genai are slow to import, so they are imported where used
 
 OUTPUT_DIR = "outputs"
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JINJA_MARKERS = ("{{", "{%", "{#")
+MAX_CONCURRENT_REQUESTS = 8  # Gemini requests in flight at once when processing several files
+EARTH_RADIUS_M = 6371e3
+TRACK_TOLERANCE_M = 10  # Max deviation allowed when simplifying the track
 
 class Tone(Enum):
     """Class representing the tone of the journal entry."""
@@ -46,38 +58,127 @@ class Length(Enum):
     MEDIUM = "medium"
     DETAILED = "detailed"
 LENGTH_HELP = "Length for the journal entry"
+NO_IMAGE_HELP = "Skip generating an image for the journal entry"
+NO_CACHE_HELP = "Always parse the GPX files and call Gemini instead of reusing cached results"
+
+JOURNAL_PROMPT_TEMPLATE = """Summarize a walk as a {length} journal entry with a {tone} tone
+that followed these GPS coordinates, given as CSV with UTC times of day: {route_data} (don't
+report the coordinates or specific timestamps back (start and end time okay). Try to focus on
+{focus} and otherwise identify one major landmark, park, or body of water near each coordinate, and
+provide a fun fact about each (but don't explicitly say fun fact each time). Comment on pace based
+on this summary: {route_summary}. Incorpoate the weather. Include a planned next walk based on the
+general area of this walk. Make the output HTML formatted. Don't provide anything after the HTML,
+nor a blurb at start, just the journal entry."""
+
+IMAGE_PROMPT_TEMPLATE = """Generate a sketch-style image with no added text of one of the locations
+mentioned in this journal entry: {journal_entry}"""
+
 
-def get_journal_prompt(route_data, tone, focus, length):
-    """Generate a journal prompt."""
-    return f"""Summarize a walk as a {length} journal entry with a {tone} tone that followed these
-GPS coordinates with timestamp: {str(route_data)} (don't report the coordinates or specific
-timestamps back (start and end time okay). Try to focus on {focus} and otherwise identify one major
-landmark, park, or body of water near each coordinate, and provide a fun fact about each (but don't
-explicitly say fun fact each time). Comment on pace based on time and disctance covered. Incorpoate
-the weather. Include a planned next walk based on the general area of this walk. Make the output
-HTML formatted. Don't provide anything after the HTML, nor a blurb at start, just the journal
-entry."""
+def get_journal_prompt(route_data, route_summary, tone, focus, length):
+    """Generate a journal prompt from the CSV route data and its distance/pace summary."""
+    # Accept Tone/Focus/Length members as well as their values, so the prompt never says "Tone.FUN"
+    tone, focus, length = (option.value if isinstance(option, Enum) else option
+                           for option in (tone, focus, length))
+    return JOURNAL_PROMPT_TEMPLATE.format(length=length, tone=tone, focus=focus,
+                                          route_data=route_data, route_summary=route_summary)
 
 
 def get_image_prompt(journal_entry):
     """Generate an image prompt based on the journal entry."""
-    return f"""Generate a sketch-style image with no added text of one of the locations mentioned
-in this journal entry: {journal_entry}"""
+    return IMAGE_PROMPT_TEMPLATE.format(journal_entry=journal_entry)
 
 
-def parse_gpx(file_path):
+def load_cache(cache_path):
+    """Loads a cached value, returning None if it is missing or unreadable (e.g. truncated)."""
+    try:
+        with open(cache_path, "rb") as cache_file:
+            return pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, ValueError) as e:
+        print(f"Ignoring unreadable cache file '{cache_path}': {e}")
+        return None
+
+
+def save_cache(cache_path, value):
+    """Saves a value to the cache through a temporary file, so readers never see a partial file."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile("wb", dir=CACHE_DIR, suffix=".tmp", delete=False) as temp_file:
+        try:
+            pickle.dump(value, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, cache_path)
+
+
+def cached_generate(client, prompt, model, modalities=None, use_cache=True):
     """
-    Parses a GPX file and extracts relevant information as a text string.
+    Generates content with Gemini, reusing the saved response for an identical earlier request.
+
+    Args:
+        client (genai.Client): The Gemini client.
+        prompt (str): The prompt to send.
+        model (str): The Gemini model name.
+        modalities (list): The response modalities, or None for text only.
+        use_cache (bool): Whether to read and write the response cache.
+
+    Returns:
+        tuple: The response text, and a list of (mime_type, data) for each inline image.
+    """
+    from google.genai import types  # pylint: disable=import-outside-toplevel
+
+    key = hashlib.sha256(f"{model}\n{modalities}\n{prompt}".encode("utf-8")).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.pkl")
+    cached = load_cache(cache_path) if use_cache else None
+    if cached is not None:
+        return cached
+
+    config = types.GenerateContentConfig(response_modalities=modalities) if modalities else None
+    response = client.models.generate_content(model=model, contents=prompt, config=config)
+
+    # Blocked or empty responses have no candidates, or a candidate without content parts
+    candidates = response.candidates or []
+    content = candidates[0].content if candidates else None
+    parts = content.parts if content is not None else None
+    if not parts:
+        print(f"No content found in the {model} response.")
+        return "", []
+
+    text = "".join(part.text for part in parts if part.text)
+    images = [(part.inline_data.mime_type, part.inline_data.data)
+              for part in parts if part.inline_data is not None]
+
+    if use_cache:
+        save_cache(cache_path, (text, images))
+    return text, images
+
+
+def parse_gpx(file_path, use_cache=True):
+    """
+    Parses a GPX file, reusing the cached parse if the file is unchanged.
 
     Args:
         file_path (str): The path to the GPX file.
+        use_cache (bool): Whether to read and write the parsed GPX cache.
 
     Returns:
         The gpx data. Returns None if the file cannot be opened or parsed.
     """
+    import gpxpy  # pylint: disable=import-outside-toplevel
+    import gpxpy.gpx  # pylint: disable=import-outside-toplevel
+
+    key = hashlib.sha256(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"gpx_{key}.pkl")
     try:
+        mtime = os.stat(file_path).st_mtime_ns
+        cached = load_cache(cache_path) if use_cache else None
+        if isinstance(cached, tuple) and len(cached) == 2 and cached[0] == mtime:
+            return cached[1]
+
         with open(file_path, 'r') as gpx_file:
-            return gpxpy.parse(gpx_file)
+            gpx = gpxpy.parse(gpx_file)
     except FileNotFoundError:
         print(f"Error: File not found at {file_path}")
         return None
@@ -85,130 +186,364 @@ def parse_gpx(file_path):
         print(f"Error parsing GPX file: {e}")
         return None
 
+    if use_cache:
+        save_cache(cache_path, (mtime, gpx))
+    return gpx
+
+
+def get_track_points(gpx):
+    """
+    Collects every track point in the gpx data as parallel arrays.
+
+    Args:
+        The gpx data.
+
+    Returns:
+        tuple: float64 arrays of latitudes and longitudes, and an object array of times.
+    """
+    points = [point for track in gpx.tracks for segment in track.segments for point in segment.points]
+    lats = np.fromiter((point.latitude for point in points), dtype=np.float64, count=len(points))
+    lons = np.fromiter((point.longitude for point in points), dtype=np.float64, count=len(points))
+    times = np.array([point.time for point in points], dtype=object)
+    return lats, lons, times
+
+
+def simplify_track(lats, lons, tolerance_m=TRACK_TOLERANCE_M):
+    """
+    Simplifies a track with the Ramer-Douglas-Peucker algorithm.
+
+    Args:
+        lats (np.ndarray): Latitudes of the track points.
+        lons (np.ndarray): Longitudes of the track points.
+        tolerance_m (float): Max distance in metres a dropped point may lie from the simplified line.
+
+    Returns:
+        np.ndarray: Indices of the points needed to keep the track within the tolerance.
+    """
+    if len(lats) < 3:
+        return np.arange(len(lats))
+
+    # Project onto a local equirectangular plane in metres
+    x = np.radians(lons) * math.cos(math.radians(lats[0])) * EARTH_RADIUS_M
+    y = np.radians(lats) * EARTH_RADIUS_M
+
+    keep = np.zeros(len(lats), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(lats) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length:
+            dists = np.abs(dy * px - dx * py) / length
+        else:  # Closed loop, measure from the shared endpoint
+            dists = np.hypot(px, py)
+
+        index = int(np.argmax(dists))
+        if dists[index] > tolerance_m:
+            index += first + 1
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return np.flatnonzero(keep)
+
+
+def get_route_summary(gpx):
+    """
+    Computes the total distance and average pace of the gpx track.
+
+    Args:
+        The gpx data.
+
+    Returns:
+        str: The total distance in km, and the average pace in min/km when the track has times.
+             Gaps between segments (paused recordings, separate tracks) are not counted.
+    """
+    lats, lons, _ = get_track_points(gpx)
+    lat, lon = np.radians(lats), np.radians(lons)
+    segments = [segment.points for track in gpx.tracks for segment in track.segments]
+
+    # Haversine distance between each pair of consecutive points
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+    distances = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+    # Drop the pairs joining the last point of one segment to the first point of the next
+    segment_ends = np.cumsum([len(points) for points in segments], dtype=np.intp)
+    distances[segment_ends[(segment_ends > 0) & (segment_ends < len(lats))] - 1] = 0
+    total_km = float(distances.sum()) / 1000
+
+    elapsed_seconds = sum((points[-1].time - points[0].time).total_seconds()
+                          for points in segments
+                          if points and points[0].time is not None and points[-1].time is not None)
+
+    summary = f"Total distance: {total_km:.2f} km"
+    if total_km and elapsed_seconds:
+        pace_min_per_km = elapsed_seconds / 60 / total_km
+        summary += f", avg pace: {pace_min_per_km:.1f} min/km"
+    return summary
+
 
 def convert_gpx_to_text(gpx):
     """
-    Parses a GPX file and extracts relevant information as a text string.
+    Converts the gpx data into compact CSV text for the journal prompt.
 
     Args:
         The gpx data.
 
     Returns:
-        str: A text representation of the GPX data, including track points
-             (latitude, longitude, elevation, time), waypoints, and route
-             points. Returns None if the file cannot be opened or parsed.
+        str: The walk date, "lat,lon,time" rows for the simplified track, followed by
+             "waypoint,lat,lon,description" rows if the file has waypoints. Coordinates
+             are rounded to 5 decimal places (about 1 m) and times are given as UTC HH:MM:SS.
     """
+    lats, lons, times = get_track_points(gpx)
+    keep = simplify_track(lats, lons)
+
+    # The prompt calls the times UTC, so convert any with an offset (naive times are taken as UTC)
+    times = [time.astimezone(datetime.timezone.utc) if time is not None and time.tzinfo else time
+             for time in times[keep]]
+
+    # csv quotes any commas, quotes or newlines in waypoint names and descriptions
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    start_time = next((time for time in times if time is not None), None)
+    if start_time is not None:
+        writer.writerow(["date", start_time.date().isoformat()])
+
+    writer.writerow(["lat", "lon", "time"])
+    for lat, lon, time in zip(lats[keep].tolist(), lons[keep].tolist(), times):
+        writer.writerow([round(lat, 5), round(lon, 5), time.strftime('%H:%M:%S') if time else ''])
 
-    output_text = "GPX Data:\n"
-
-    # Process tracks
-    if gpx.tracks:
-        output_text += "\nTracks:\n"
-        for track in gpx.tracks:
-            output_text += f"  Name: {track.name}\n"
-            for segment in track.segments:
-                output_text += "    Segment Points:\n"
-                for point in segment.points:
-                    output_text += f"      Lat: {point.latitude}, Lon: {point.longitude}, "
-                    if point.elevation is not None:
-                        output_text += f"Elev: {point.elevation}, "
-                    if point.time is not None:
-                        output_text += f"Time: {point.time.isoformat()} UTC\n"
-
-    # Process waypoints
     if gpx.waypoints:
-        output_text += "\nWaypoints:\n"
+        writer.writerow(["waypoint", "lat", "lon", "description"])
         for waypoint in gpx.waypoints:
-            output_text += f"  Name: {waypoint.name}, Lat: {waypoint.latitude}, Lon: {waypoint.longitude}\n"
-            if waypoint.elevation is not None:
-                output_text += f"    Elev: {waypoint.elevation}\n"
-            if waypoint.time is not None:
-                output_text += f"    Time: {waypoint.time.isoformat()} UTC\n"
-            if waypoint.description:
-                output_text += f"    Description: {waypoint.description}\n"
-
-    # Process routes
-    if gpx.routes:
-        output_text += "\nRoutes:\n"
-        for route in gpx.routes:
-            output_text += f"  Name: {route.name}\n"
-            output_text += "    Route Points:\n"
-            for point in route.points:
-                output_text += f"      Lat: {point.latitude}, Lon: {point.longitude}, "
-                if point.elevation is not None:
-                    output_text += f"Elev: {point.elevation}, "
-                if point.time is not None:
-                    output_text += f"Time: {point.time.isoformat()} UTC\n"
-                if point.description:
-                    output_text += f"      Description: {point.description}\n"
-
-    return output_text
+            writer.writerow([waypoint.name or '', round(waypoint.latitude, 5),
+                             round(waypoint.longitude, 5), waypoint.description or ''])
 
+    return output.getvalue().rstrip("\n")
 
-def generate_map(gpx_coordinates):
-    """builds a map from the gpx coordinates"""
-    coordinates = []
-    for track in gpx_coordinates.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                coordinates.append((point.latitude, point.longitude, point.time))
 
-    # Create a map centered around the first point
-    output_map = folium.Map(location=(coordinates[0][0], coordinates[0][1]), zoom_start=14)
+class StaticTemplate:
+    """Class standing in for a Jinja2 template whose source has no Jinja syntax."""
+
+    def __init__(self, source):
+        # Match Jinja's newline normalization and trailing newline removal
+        lines = re.split(r"\r\n|\r|\n", source)
+        if lines[-1] == "":
+            del lines[-1]
+        self.text = "\n".join(lines)
+
+    def render(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Returns the source text."""
+        return self.text
+
+
+def compile_template(source):
+    """Builds a template for branca, skipping compilation when the source is plain text."""
+    import jinja2  # pylint: disable=import-outside-toplevel
+
+    if not any(marker in source for marker in JINJA_MARKERS):
+        return StaticTemplate(source)
+    return jinja2.Template(source)
+
+
+def dumps_json(obj, **kwargs):
+    """
+    Serializes obj to JSON with orjson, falling back to json for types orjson doesn't support.
+
+    Unlike json.dumps, which writes NaN and Infinity as-is, orjson writes them as null.
+    """
+    import orjson  # pylint: disable=import-outside-toplevel
+
+    try:
+        option = orjson.OPT_SORT_KEYS if kwargs.get("sort_keys") else None
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    except TypeError:
+        return json.dumps(obj, **kwargs)
+
+
+_FOLIUM_PATCHED = False
+
+
+def _patch_folium():
+    """
+    Speeds up folium map rendering for this process. Only the first call has any effect.
+
+    branca compiles a new Jinja2 template for every element built from a string, even though
+    folium mostly passes it already rendered HTML/JS, so plain-text sources skip compilation.
+    JSON in folium's templates is also serialized with orjson when it is installed.
+    """
+    global _FOLIUM_PATCHED  # pylint: disable=global-statement
+    if _FOLIUM_PATCHED:
+        return
+    _FOLIUM_PATCHED = True
+
+    import branca.element  # pylint: disable=import-outside-toplevel
+
+    branca.element.Template = compile_template
+
+    # folium serializes polylines and GeoJSON layers through the tojson filter of its shared
+    # Jinja2 environment, so use the faster orjson there when it is installed
+    if importlib.util.find_spec("orjson") is not None:
+        import folium  # pylint: disable=import-outside-toplevel
+
+        folium.PolyLine._template.environment.policies["json.dumps_function"] = dumps_json
 
-    start_coord = (coordinates[0][0], coordinates[0][1])
-    end_coord = (coordinates[-1][0], coordinates[-1][1])
-    is_loop = start_coord == end_coord
 
-    for i, coord in enumerate(coordinates):
-        color = 'blue'  # Default for non-start/end
+def generate_map(gpx_coordinates):
+    """builds a map from the gpx coordinates"""
+    import folium  # pylint: disable=import-outside-toplevel
 
-        if i == 0:
-            color = 'green'
-        elif i == len(coordinates) - 1:
-            color = 'purple' if is_loop else 'red'
+    lats, lons, times = get_track_points(gpx_coordinates)
+    keep = simplify_track(lats, lons)
+    # [lat, lon] pairs built in one pass over the contiguous arrays
+    coordinates = np.column_stack((lats[keep], lons[keep])).tolist()
+    times = times[keep]
 
-        folium.Marker((coord[0], coord[1]), popup=f"Time: {coord[2]}",
-                      icon=folium.Icon(color=color)).add_to(output_map)
+    # Create a map centered around the first point
+    output_map = folium.Map(location=coordinates[0], zoom_start=14)
+
+    is_loop = coordinates[0] == coordinates[-1]
+
+    # Draw the intermediate points client-side from a single GeoJSON layer
+    features = [{"type": "Feature",
+                 "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                 "properties": {"time": str(time)}}
+                for (lat, lon), time in zip(coordinates[1:-1], times[1:-1])]
+    if features:
+        folium.GeoJson({"type": "FeatureCollection", "features": features},
+                       name="Track points",
+                       marker=folium.CircleMarker(radius=5, color="blue", fill=True,
+                                                  fill_opacity=0.8),
+                       popup=folium.GeoJsonPopup(fields=["time"], aliases=["Time:"])
+                       ).add_to(output_map)
+
+    # Only the start and end points get full markers
+    folium.Marker(coordinates[0], popup=f"Time: {times[0]}",
+                  icon=folium.Icon(color='green')).add_to(output_map)
+    if len(coordinates) > 1:
+        folium.Marker(coordinates[-1], popup=f"Time: {times[-1]}",
+                      icon=folium.Icon(color='purple' if is_loop else 'red')).add_to(output_map)
 
     # Add a Polyline to connect the points
-    folium.PolyLine([(coord[0], coord[1]) for coord in coordinates], color="blue",
-                    weight=5).add_to(output_map)
+    folium.PolyLine(coordinates, color="blue", weight=5).add_to(output_map)
 
     return output_map
 
 
-def build_output_html(m, journal_entry, image):
-    """Builds the HTML output with the map and journal, and image."""
-    html_image = ""
+def generate_story(client, route_data, route_summary, args):
+    """
+    Produces the journal entry, then its image, for one route.
 
-    for part in image.candidates[0].content.parts:
-        if part.inline_data is not None:
-            image_result = Image.open(BytesIO((part.inline_data.data)))
-            buffered = BytesIO()
-            image_result.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    Args:
+        client (genai.Client): The Gemini client.
+        route_data (str): The CSV route data from convert_gpx_to_text.
+        route_summary (str): The distance/pace summary from get_route_summary.
+        args (argparse.Namespace): The tone, focus, length, no_image and no_cache options.
 
-            html_image += f'<img src="data:image/png;base64,{img_str}" alt="Generated Image"><br><br>'
-        else:
-            print("No image data found in the response.")
+    Returns:
+        tuple: The journal text, and a list of (mime_type, data) images or None if skipped.
 
-    # Get the HTML representation of the map
-    map_html = m.get_root().render()
+    Raises:
+        ValueError: If the journal response was blocked or empty.
+    """
+    journal_text, _ = cached_generate(client,
+                                      get_journal_prompt(route_data,
+                                                         route_summary,
+                                                         args.tone,
+                                                         args.focus,
+                                                         args.length),
+                                      model="gemini-2.0-flash",
+                                      use_cache=not args.no_cache)
+    if not journal_text:
+        # Don't pay for an image, or save an output, for a blocked or empty journal
+        raise ValueError("Gemini returned no journal entry.")
+    if args.no_image:
+        return journal_text, None
+
+    _, images = cached_generate(client,
+                                get_image_prompt(journal_text),
+                                model='gemini-2.0-flash-exp',
+                                modalities=['Text', 'Image'],
+                                use_cache=not args.no_cache)
+    return journal_text, images
+
+
+def start_output_html(map_html):
+    """
+    Starts an output by writing the rendered map up to its <body> tag to a temporary file.
 
-    # Inject the AI summary
-    journal_html = f"<div style='font-family: Arial; margin: 20px;'><h2>Walk Summary</h2><p>\
-        {journal_entry.text}</p></div>"
+    This runs while the Gemini requests are in flight; finish_output_html adds the rest and
+    moves the file into place, and discard_output_html removes it if the story fails.
 
-    return map_html.replace("<body>", f"<body>{journal_html}{html_image}")
+    Returns:
+        tuple: The open temporary file, and the rest of the map HTML.
+    """
+    body_index = map_html.find("<body>") + len("<body>")
+    temp_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", buffering=1 << 20,
+                                            dir=OUTPUT_DIR, suffix=".tmp", delete=False)
+    temp_file.write(map_html[:body_index])
+    return temp_file, map_html[body_index:]
 
 
-if __name__ == "__main__":
+def discard_output_html(output):
+    """Closes and deletes the temporary file of an output that was started but not finished."""
+    temp_file, _ = output
+    temp_file.close()
+    if os.path.exists(temp_file.name):
+        os.remove(temp_file.name)
+
+
+def finish_output_html(output, file_path, journal_text, images=None):
+    """
+    Writes the journal, images, and rest of the map to a started output, then moves it to file_path.
+
+    images is a list of (mime_type, data) tuples, or None if no image was requested. If anything
+    fails the temporary file is discarded, so no partial output is left behind.
+    """
+    import base64  # pylint: disable=import-outside-toplevel
 
+    temp_file, map_tail = output
+    try:
+        # Inject the AI summary and images after the map's <body> tag
+        temp_file.write(f"<div style='font-family: Arial; margin: 20px;'><h2>Walk Summary</h2><p>\
+        {journal_text}</p></div>")
+
+        for mime_type, data in images or ():
+            # Gemini normally returns PNG already, so only re-encode other formats
+            if mime_type != "image/png" and not data.startswith(PNG_SIGNATURE):
+                from PIL import Image  # pylint: disable=import-outside-toplevel
+
+                buffered = io.BytesIO()
+                Image.open(io.BytesIO(data)).save(buffered, format="PNG")
+                data = buffered.getvalue()
+            img_str = base64.b64encode(data).decode('ascii')
+            temp_file.write(f'<img src="data:image/png;base64,{img_str}" alt="Generated Image">'
+                            '<br><br>')
+
+        temp_file.write(map_tail)
+        temp_file.close()
+        os.replace(temp_file.name, file_path)
+    except BaseException:
+        discard_output_html(output)
+        raise
+
+    if images is not None and not images:
+        print("No image data found in the response.")
+
+
+def main():
+    """Generates the map, journal, and image for each GPX file given on the command line."""
     parser = argparse.ArgumentParser(description="Generate map, journal, and image from GPX data.")
     parser.add_argument("--gpx",
-                        default="inputs/ottawa.gpx",
-                        help="Path to the GPX file")
+                        default=["inputs/ottawa.gpx"],
+                        nargs="+",
+                        help="Path to one or more GPX files")
     parser.add_argument("--tone",
                         default=Tone.NEUTRAL.value,
                         choices=[e.value for e in Tone],
@@ -221,6 +556,12 @@ if __name__ == "__main__":
                         default=Length.MEDIUM.value,
                         choices=[e.value for e in Length],
                         help=LENGTH_HELP)
+    parser.add_argument("--no-image",
+                        action="store_true",
+                        help=NO_IMAGE_HELP)
+    parser.add_argument("--no-cache",
+                        action="store_true",
+                        help=NO_CACHE_HELP)
 
     args = parser.parse_args()
 
@@ -231,46 +572,74 @@ if __name__ == "__main__":
         raise ValueError("GEMINI_API_KEY environment variable not set.")
 
 
-    # Parse the GPX file and extract relevant data
-    gpx_data = parse_gpx(args.gpx)
-    if gpx_data is not None:
-        parsed_route_data = convert_gpx_to_text(gpx_data)
-        if parsed_route_data is None:
-            raise ValueError("unable to retrieve gpx trip data.")
-    else:
-        raise ValueError(f"Unable to parse GPX data in '{args.gpx}'.")
-
-
-    # Produce the journal entry using Gemini AI
-    client = genai.Client(api_key=api_key)
-    JOURNAL_ENTRY = client.models.generate_content(model="gemini-2.0-flash",
-                                                contents=get_journal_prompt(parsed_route_data,
-                                                                            args.tone,
-                                                                            args.focus,
-                                                                            args.length))
-
-
-    # Produce image using Gemini AI
-    image_response = client.models.generate_content(
-        model='gemini-2.0-flash-exp',
-        contents=get_image_prompt(JOURNAL_ENTRY.text),
-        config=types.GenerateContentConfig(
-        response_modalities=['Text', 'Image']
-        )
-    )
-
-
-    # Generate the map using Folium
-    m = generate_map(gpx_data)
+    # Parse the GPX files and extract relevant data
+    gpx_files = []
+    for gpx_path in args.gpx:
+        gpx_data = parse_gpx(gpx_path, use_cache=not args.no_cache)
+        if gpx_data is not None:
+            parsed_route_data = convert_gpx_to_text(gpx_data)
+            if parsed_route_data is None:
+                raise ValueError("unable to retrieve gpx trip data.")
+            route_summary = get_route_summary(gpx_data)
+        else:
+            raise ValueError(f"Unable to parse GPX data in '{gpx_path}'.")
+        if not any(segment.points for track in gpx_data.tracks for segment in track.segments):
+            raise ValueError(f"No track points in GPX data in '{gpx_path}'.")
+        gpx_files.append((gpx_data, parsed_route_data, route_summary))
 
 
-    # Build the HTML output with the map, journal entry, and image
-    OUTPUT_HTML = build_output_html(m, JOURNAL_ENTRY, image_response)
+    # Produce the journal entries and images using Gemini AI, generating the maps while the
+    # requests are in flight
+    from google import genai  # pylint: disable=import-outside-toplevel
 
+    client = genai.Client(api_key=api_key)
+    _patch_folium()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        story_futures = {executor.submit(generate_story, client, parsed_route_data,
+                                         route_summary, args): index
+                         for index, (_, parsed_route_data, route_summary) in enumerate(gpx_files)}
+
+
+        outputs = []
+        failed_paths = []
+        try:
+            # Generate the maps using Folium and start writing each output with its map
+            for story_future, (gpx_data, _, _) in zip(story_futures, gpx_files):
+                try:
+                    outputs.append(start_output_html(generate_map(gpx_data).get_root().render()))
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    gpx_path = args.gpx[story_futures[story_future]]
+                    print(f"Error generating the map for '{gpx_path}': {e}")
+                    failed_paths.append(gpx_path)
+                    story_future.cancel()
+                    outputs.append(None)
+
+
+            # Finish the HTML outputs as each story completes, keeping the others if one fails
+            for story_future in as_completed(story_futures):
+                output = outputs[story_futures[story_future]]
+                gpx_path = args.gpx[story_futures[story_future]]
+                if output is None:  # The map already failed
+                    continue
+                try:
+                    journal_text, images = story_future.result()
+                    output_filepath = os.path.join(OUTPUT_DIR, f"trip_{uuid.uuid4().hex}.html")
+                    finish_output_html(output, output_filepath, journal_text, images)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    print(f"Error generating the story for '{gpx_path}': {e}")
+                    failed_paths.append(gpx_path)
+                    discard_output_html(output)
+                    continue
+                print(f"Output saved to '{output_filepath}' for '{gpx_path}'")
+        finally:
+            # Remove the temporary files of any outputs left unfinished by an error
+            for output in outputs:
+                if output is not None:
+                    discard_output_html(output)
+
+    if failed_paths:
+        raise RuntimeError(f"Unable to generate stories for {', '.join(failed_paths)}.")
 
-    # Save the HTML output to a file
-    OUTPUT_FILEPATH = os.path.join(OUTPUT_DIR, f"trip_{uuid.uuid4().hex}.html")
-    with open(OUTPUT_FILEPATH, "w", encoding="utf-8") as file:
-        file.write(OUTPUT_HTML)
 
-    print(f"Output saved to '{OUTPUT_FILEPATH}'")
+if __name__ == "__main__":
+    main()